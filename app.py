@@ -1,15 +1,23 @@
-import os, json, uuid, textwrap, asyncio, csv
+import os, re, json, uuid, asyncio, atexit, threading, hashlib, queue, time, random
+import collections, csv, io
+import concurrent.futures
 from pathlib import Path
-from typing import List
+from typing import List, Optional, TYPE_CHECKING
+from dataclasses import dataclass, field
 from datetime import datetime
-import pandas as pd
 
 import streamlit as st
+try:
+    import orjson # Optional: faster JSON for batch-job files
+except ImportError:
+    orjson = None
 from dotenv import load_dotenv
-from firecrawl import FirecrawlApp
-from openai import OpenAI
-from agents import Agent, Runner
-import tiktoken
+
+from chunker import CHUNK_SEPARATOR, ENCODER_MODEL, approx_tokens, create_context_chunks, get_encoder, select_relevant_chunks
+
+# `agents`, `tiktoken`, `openai`, `firecrawl`, `httpx` and `pandas` are imported lazily where used to keep cold start fast
+if TYPE_CHECKING:
+    from agents import Agent
 
 # ----------------- ENV & CONSTANTS -----------------
 load_dotenv()
@@ -17,162 +25,446 @@ load_dotenv()
 APP_NAME    = "Personalization Agent (Beta V0)"
 DATA_DIR    = Path(__file__).parent
 FEEDBACK_FILE = DATA_DIR / "feedback.csv"
-USAGE_LOG_FILE = DATA_DIR / "usage_log.csv"
+USAGE_LOG_FILE = DATA_DIR / "usage_log.jsonl"
+BATCH_JOBS_FILE = DATA_DIR / "batch_jobs.jsonl" # Submitted batch jobs, so they survive closed tabs and restarts
+SCRAPE_CACHE_DIR = DATA_DIR / ".cache" # Scraped markdown, one file per (url, wait, main-content) key
 
 OPENAI_KEY      = os.getenv("OPENAI_API_KEY")
 FIRECRAWL_KEY   = os.getenv("FIRECRAWL_API_KEY")
 
 MAX_URL_LENGTH = 1000
+_URL_RE = re.compile(r"https?://\S+", re.IGNORECASE) # http(s) URL with no whitespace; length is checked separately
+SCRAPE_CONCURRENCY = max(1, int(os.getenv("SCRAPE_CONCURRENCY", "5"))) # Parallel Firecrawl requests; raise to match your plan's limit
+GENERATE_CONCURRENCY = max(1, int(os.getenv("GENERATE_CONCURRENCY", "8"))) # Parallel agent requests in CSV runs; lower it if you hit 429s
+DEBUG_SCRAPE = bool(int(os.getenv("DEBUG_SCRAPE", "0"))) # Set DEBUG_SCRAPE=1 for scrape debug prints
+DEBUG_PROMPT_CACHE = bool(int(os.getenv("DEBUG_PROMPT_CACHE", "0"))) # Set DEBUG_PROMPT_CACHE=1 to print cached prompt tokens
+MAX_CONTEXT_CHARS = 80000 # Hard cap on PAGE_TEXT sent to the agent
+MAX_PAGE_CHARS = MAX_CONTEXT_CHARS + MAX_CONTEXT_CHARS // 5 # Scraped markdown kept per page (budget + 20%, for relevance selection to choose from)
+# Fail hung OpenAI requests instead of blocking the rerun. Read covers time to first byte, which on unstreamed
+# calls to reasoning models (o3, o4-mini) with long inputs includes all of their thinking, so it allows minutes
+OPENAI_TIMEOUT = {"timeout": 300.0, "connect": 5.0, "write": 10.0, "pool": 5.0} # httpx.Timeout arguments
+OPENAI_MAX_RETRIES = 2
+OPENAI_HTTP_LIMITS = {"max_connections": 64, "max_keepalive_connections": 32} # httpx.Limits arguments; keeps CSV-run connections warm
+# Client-side limits for agent calls (0 = unlimited); set them to your OpenAI tier to avoid 429 storms
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "0"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "0"))
+AGENT_MAX_ATTEMPTS = 4 # Agent runs retried on sustained rate limiting (after the client's own retries)
+LOG_FLUSH_INTERVAL = 0.1 # Seconds the log writer waits to batch rows before writing
+MIN_PAGE_TOKENS = 150 # Pages estimated below this many tokens (whitespace collapsed) skip the agent and get FALLBACK_LINE
+BLOCK_PAGE_MAX_TOKENS = 4 * MIN_PAGE_TOKENS # Only pages shorter than this are checked for block/error-page phrases
+RELEVANCE_CHUNK_TOKENS = 500 # Chunk size when an over-budget page is cut down to the parts matching EMAIL_PURPOSE
+# PAGE_TEXT token budget in precise mode (~4 chars per token); with the ~1-2k-token prompt it stays far inside the 128k context window
+MAX_CONTEXT_TOKENS = MAX_CONTEXT_CHARS // 4
+RESPONSE_TOKEN_BUDGET = 1000 # Reply tokens counted against OPENAI_TPM per call (a batch reply holds up to 10 lines)
+PAGE_VIEW_CHARS = 5000 # Page text shown per part in the "View Analyzed Page Content" expander
+SCRAPE_CACHE_TTL = 24 * 3600 # Seconds a scraped page on disk is reused before re-scraping
+SCRAPE_CACHE_MAX_FILES = int(os.getenv("SCRAPE_CACHE_MAX_FILES", "2000")) # Oldest cached pages beyond this are evicted on write
+SCRAPE_CACHE_EVICT_INTERVAL = 300 # Seconds between eviction passes over the scrape cache
+BATCH_JOBS_MAX_AGE = 7 * 24 * 3600 # Seconds after submission a batch job is still listed under Jobs
 
 if not (OPENAI_KEY and FIRECRAWL_KEY):
     st.stop("❌ Set OPENAI_API_KEY and FIRECRAWL_API_KEY in a .env file.")
 
-firecrawl = FirecrawlApp(api_key=FIRECRAWL_KEY)
-client    = OpenAI(api_key=OPENAI_KEY)
-
-# Initialize session state
-if 'generated_line' not in st.session_state:
-    st.session_state.generated_line = None
-if 'page_text' not in st.session_state:
-    st.session_state.page_text = None
-if 'source_url' not in st.session_state:
-    st.session_state.source_url = None
-if 'csv_results' not in st.session_state:
-    st.session_state.csv_results = None
-if 'processing_status' not in st.session_state:
-    st.session_state.processing_status = None
+# Initialize session state: one AppState per session, read and written as `state.<field>`
+@dataclass(slots=True)
+class AppState:
+    generated_line: Optional[str] = None
+    page_text: Optional[str] = None
+    page_text_hash: Optional[str] = None
+    source_url: Optional[str] = None
+    csv_urls: Optional[List[str]] = None
+    csv_results: Optional[dict] = None # Column name -> list of values (url, opening_line, status)
+    processing_status: Optional[str] = None
+    csv_pages: Optional[dict] = None
+    batch_jobs: List[dict] = field(default_factory=list)
+
+def _load_batch_jobs() -> List[dict]:
+    """Batch jobs from BATCH_JOBS_FILE submitted within BATCH_JOBS_MAX_AGE, oldest first."""
+    jobs = []
+    try:
+        with open(BATCH_JOBS_FILE, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    job = json.loads(line)
+                except ValueError:
+                    continue # Partial line from an interrupted write
+                if time.time() - job.get("submitted_ts", 0) < BATCH_JOBS_MAX_AGE:
+                    job["results"] = None # Fetched from OpenAI again once the job has completed
+                    jobs.append(job)
+    except OSError:
+        pass # No jobs submitted yet
+    return jobs
+
+if 'app' not in st.session_state:
+    st.session_state.app = AppState(batch_jobs=_load_batch_jobs())
+state = st.session_state.app
 
 # ----------------- HELPERS -----------------
 
-# Improved Chunking Function
-def create_context_chunks(markdown_text: str, max_tokens=3000, overlap=100) -> List[str]:
-    """Creates text chunks respecting paragraphs, splitting large paragraphs with overlap."""
-    enc = tiktoken.encoding_for_model("gpt-4o-mini") # Align with agent model if different
+@st.cache_resource
+def get_firecrawl():
+    """Process-wide Firecrawl client."""
+    from firecrawl import FirecrawlApp
+    return FirecrawlApp(api_key=FIRECRAWL_KEY)
 
-    paragraphs = markdown_text.split('\n\n')
+@st.cache_resource
+def get_openai_client():
+    """Process-wide sync OpenAI client, used for Batch API files and jobs."""
+    import httpx
+    from openai import OpenAI, DefaultHttpxClient
+    return OpenAI(
+        api_key=OPENAI_KEY,
+        max_retries=OPENAI_MAX_RETRIES,
+        http_client=DefaultHttpxClient(timeout=httpx.Timeout(**OPENAI_TIMEOUT), limits=httpx.Limits(**OPENAI_HTTP_LIMITS))
+    )
 
-    chunks = []
-    current_chunk_para_list = []
-    current_token_count = 0
+def _json_dumps(obj) -> str:
+    """json.dumps via orjson when it is installed."""
+    return orjson.dumps(obj).decode() if orjson else json.dumps(obj)
 
-    for para in paragraphs:
-        para = para.strip()
-        if not para:
-            continue
+def _json_loads(text: str):
+    """json.loads via orjson when it is installed."""
+    return orjson.loads(text) if orjson else json.loads(text)
+
+# Markers of bot walls and error pages, matched near the top of the scraped text in one scan
+_BLOCK_PAGE_RE = re.compile(
+    r"just a moment\.\.\."
+    r"|attention required! \| cloudflare"
+    r"|checking your browser before accessing"
+    r"|access denied"
+    r"|403 forbidden"
+    r"|404 not found"
+    r"|please enable javascript",
+    re.IGNORECASE
+)
+
+def _unusable_page(page_text: str) -> bool:
+    """True if the agent could only fall back: too little text, or a block/error page.
+
+    The block-page phrases also turn up on real pages (noscript banners, security
+    vendors), so they only count on pages too short to hold much else.
+    """
+    tokens = approx_tokens(" ".join(page_text.split()))
+    if tokens < MIN_PAGE_TOKENS:
+        return True
+    if tokens >= BLOCK_PAGE_MAX_TOKENS:
+        return False
+    match = _BLOCK_PAGE_RE.search(page_text, 0, 2000)
+    if match and DEBUG_SCRAPE:
+        print(f"Skipping agent, page looks blocked ({match.group(0)!r})") # Debug print
+    return match is not None
+
+def _to_csv(header: List[str], rows) -> str:
+    """Formats `rows` under `header` as CSV text with the stdlib writer (no DataFrame needed)."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return buf.getvalue()
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cuts `text` to at most `max_tokens` tokens, on a token boundary (one encode, one decode)."""
+    enc = get_encoder(ENCODER_MODEL)
+    # Tokens rarely span more than ~10 chars, so nothing past this slice could fit anyway
+    tokens = enc.encode_ordinary(text[:max_tokens * 10])
+    if len(tokens) <= max_tokens and len(text) <= max_tokens * 10:
+        return text
+    # A token boundary can fall inside a multi-byte character, which decodes to U+FFFD
+    return enc.decode(tokens[:max_tokens]).rstrip("\ufffd")
+
+def _scrape_cache_path(url: str, wait_ms: int, main_content_only: bool) -> Path:
+    """Disk-cache file for a scrape, named by a hash of its arguments."""
+    key = f"{url}|{wait_ms}|{int(main_content_only)}"
+    return SCRAPE_CACHE_DIR / f"{hashlib.sha256(key.encode()).hexdigest()}.md"
+
+@st.cache_resource
+def _get_evict_state() -> dict:
+    """Process-wide eviction lock and last-run time (module globals reset on every rerun)."""
+    return {"lock": threading.Lock(), "last": 0.0}
+
+def _evict_scrape_cache() -> None:
+    """Deletes expired cached pages, then the oldest ones beyond SCRAPE_CACHE_MAX_FILES.
 
-        para_tokens = enc.encode(para)
-        para_token_count = len(para_tokens)
-
-        # Case 1: Single paragraph is too large
-        if para_token_count > max_tokens:
-            # If there's content in the current chunk, add it to chunks list first
-            if current_chunk_para_list:
-                chunks.append('\n\n'.join(current_chunk_para_list))
-                current_chunk_para_list = []
-                current_token_count = 0
-
-            # Split the large paragraph with overlap
-            start_index = 0
-            while start_index < para_token_count:
-                end_index = min(start_index + max_tokens, para_token_count)
-                chunk_tokens = para_tokens[start_index:end_index]
-                chunks.append(enc.decode(chunk_tokens))
-                # Move start index for the next chunk, considering overlap
-                start_index += (max_tokens - overlap)
-                if start_index >= end_index: # Prevent infinite loop on very small overlap/max_tokens
-                    break
-            continue # Move to the next paragraph
-
-        # Case 2: Adding this paragraph would exceed the limit
-        # Add 2 tokens for the potential '\n\n' separator
-        if current_token_count + para_token_count + (2 if current_chunk_para_list else 0) > max_tokens:
-            # Add the current chunk to the list
-            if current_chunk_para_list:
-                chunks.append('\n\n'.join(current_chunk_para_list))
-
-            # Start new chunk with the current paragraph
-            current_chunk_para_list = [para]
-            current_token_count = para_token_count
-        # Case 3: Adding this paragraph fits
-        else:
-            current_chunk_para_list.append(para)
-            # Add token count for paragraph and potentially the separator
-            current_token_count += para_token_count + (2 if len(current_chunk_para_list) > 1 else 0)
-
-    # Add any remaining content in the last chunk
-    if current_chunk_para_list:
-        chunks.append('\n\n'.join(current_chunk_para_list))
-
-    # If no chunks were created (e.g., empty input), return a list with an empty string
-    if not chunks:
-         return [""]
-
-    return chunks
-
-def scrape_page(url: str, wait_ms: int = 2000) -> str:
-    """Scrapes a single URL using Firecrawl, returning Markdown content."""
+    Runs at most once per SCRAPE_CACHE_EVICT_INTERVAL per process; concurrent
+    callers return at once. Also removes .tmp files left behind by crashed writers.
+    """
+    evict_state = _get_evict_state()
+    if not evict_state["lock"].acquire(blocking=False):
+        return # Another thread is already evicting
+    try:
+        if evict_state["last"] and time.monotonic() - evict_state["last"] < SCRAPE_CACHE_EVICT_INTERVAL:
+            return
+        evict_state["last"] = time.monotonic()
+        _evict_scrape_cache_files()
+    finally:
+        evict_state["lock"].release()
+
+def _evict_scrape_cache_files() -> None:
+    """One eviction pass over SCRAPE_CACHE_DIR (see `_evict_scrape_cache`)."""
+    now = time.time()
+    entries = []
+    for entry in os.scandir(SCRAPE_CACHE_DIR):
+        try:
+            mtime = entry.stat().st_mtime
+            if entry.name.endswith(".tmp"):
+                if now - mtime >= 60:
+                    os.unlink(entry.path) # Orphaned by a writer that died mid-write
+                continue
+            if not entry.name.endswith(".md"):
+                continue
+            if now - mtime >= SCRAPE_CACHE_TTL:
+                os.unlink(entry.path) # Would be re-scraped anyway
+            else:
+                entries.append((mtime, entry.path))
+        except OSError:
+            pass # Removed by another process meanwhile
+    if len(entries) > SCRAPE_CACHE_MAX_FILES:
+        entries.sort()
+        for _, path in entries[:len(entries) - SCRAPE_CACHE_MAX_FILES]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+def forget_scrape(url: str, wait_ms: int, main_content_only: bool) -> None:
+    """Drops the cached copies of a scrape so the next call re-fetches the page."""
+    _scrape_cache_path(url, wait_ms, main_content_only).unlink(missing_ok=True)
+    scrape_page.clear() # Other entries are still on disk, so this only costs a file read each
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def scrape_page(url: str, wait_ms: int = 2000, main_content_only: bool = False) -> str:
+    """Scrapes a single URL using Firecrawl, returning Markdown content.
+
+    With `main_content_only`, Firecrawl strips nav, header and footer boilerplate
+    before converting to Markdown. Cached per (url, wait_ms, main_content_only) in
+    memory for an hour and on disk (SCRAPE_CACHE_DIR) for SCRAPE_CACHE_TTL, so
+    restarts and other processes reuse it; failed scrapes raise and are not cached.
+    Writes also trigger eviction of expired and excess files (at most every few minutes).
+    """
+    cache_path = _scrape_cache_path(url, wait_ms, main_content_only)
+    try:
+        if time.time() - cache_path.stat().st_mtime < SCRAPE_CACHE_TTL:
+            return cache_path.read_text(encoding="utf-8")
+    except OSError:
+        pass # Not cached (or unreadable); scrape it
     # Potential future improvements:
-    # - Explore `pageOptions={'onlyMainContent': True}` if switching to JSON format.
     # - Use Firecrawl 'actions' for pages requiring complex interaction.
     # - More specific error handling for Firecrawl exceptions.
     md_content = ""
     try:
-        print(f"Attempting to scrape: {url} with wait {wait_ms}ms") # Debug print
-        res = firecrawl.scrape_url(url, formats=["markdown"], waitFor=wait_ms)
+        if DEBUG_SCRAPE:
+            print(f"Attempting to scrape: {url} with wait {wait_ms}ms") # Debug print
+        res = get_firecrawl().scrape_url(url, formats=["markdown"], waitFor=wait_ms, onlyMainContent=main_content_only)
         # print(f"Scrape response received: {res}") # Debug print
         md_content = res.markdown if res else ""
         if not md_content:
-            print(f"Scraping resulted in empty content for: {url}") # Debug print
+            if DEBUG_SCRAPE:
+                print(f"Scraping resulted in empty content for: {url}") # Debug print
             # More specific error message
             raise RuntimeError(f"🔥 No Markdown text extracted from {url}. Page might block scraping or need longer wait.")
-        print(f"Scraping successful for: {url}") # Debug print
+        if DEBUG_SCRAPE:
+            print(f"Scraping successful for: {url}") # Debug print
+        # Nothing past MAX_PAGE_CHARS can reach the agent, so don't cache or store it
+        md_content = md_content[:MAX_PAGE_CHARS]
+        try:
+            # Write aside and rename, so a concurrent reader never sees (and re-serves) a partial file
+            SCRAPE_CACHE_DIR.mkdir(exist_ok=True) # Here rather than at import, which Streamlit repeats on every rerun
+            tmp_path = cache_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            tmp_path.write_text(md_content, encoding="utf-8")
+            os.replace(tmp_path, cache_path)
+            _evict_scrape_cache()
+        except OSError as cache_e:
+            if DEBUG_SCRAPE:
+                print(f"Could not cache scrape of {url}: {cache_e}") # Debug print
         return md_content # Return successfully scraped content
     except Exception as e:
-        print(f"Scraping failed for {url}. Error: {e}") # Debug print
+        if DEBUG_SCRAPE:
+            print(f"Scraping failed for {url}. Error: {e}") # Debug print
         # Catch potential Firecrawl specific errors if the SDK defines them, otherwise generic
         raise RuntimeError(f"Scraping failed for {url}. Reason: {e}")
 
+async def scrape_many(urls: List[str], wait_ms: int, main_content_only: bool = False, concurrency: int = SCRAPE_CONCURRENCY) -> dict:
+    """Scrapes several URLs concurrently (at most `concurrency` in flight).
+
+    Returns a dict of url -> markdown, or url -> Exception for failed scrapes.
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def bounded(url: str):
+        async with sem:
+            # Firecrawl's SDK is synchronous, so run each call in a worker thread
+            return await asyncio.to_thread(scrape_page, url, wait_ms, main_content_only)
+
+    unique_urls = list(dict.fromkeys(urls)) # Scrape repeated URLs once
+    results = await asyncio.gather(*(bounded(u) for u in unique_urls), return_exceptions=True)
+    return dict(zip(unique_urls, results))
+
+@st.cache_resource
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """Process-wide event loop on a daemon thread, so async clients keep their connection pools across runs."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="agent-event-loop", daemon=True).start()
+    return loop
+
+def submit_async(coro):
+    """Schedules `coro` on the shared background event loop; returns a concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop())
+
+def run_async(coro):
+    """Runs `coro` on the shared background event loop and blocks until it finishes."""
+    return submit_async(coro).result()
+
+def call_in_thread(fn, *args, **kwargs) -> concurrent.futures.Future:
+    """Runs `fn` on a thread attached to the current script run, so the script can keep rendering meanwhile."""
+    from streamlit.runtime.scriptrunner import add_script_run_ctx
+    future = concurrent.futures.Future()
+
+    def target():
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+    thread = threading.Thread(target=target, daemon=True)
+    add_script_run_ctx(thread)
+    thread.start()
+    return future
+
+def _drain_log_queue(log_q: queue.Queue, handles: dict, lock: threading.Lock, entries: list = None) -> None:
+    """Writes `entries` plus every queued (log_file, record) entry as JSON lines.
+
+    Log files are opened once and kept open in `handles`; each drain ends with a single flush per file.
+    """
+    entries = list(entries or [])
+    while True:
+        try:
+            entries.append(log_q.get_nowait())
+        except queue.Empty:
+            break
+    records_by_file = {}
+    for log_file, record in entries:
+        records_by_file.setdefault(log_file, []).append(record)
+    with lock: # The exit-time drain can overlap the writer thread
+        for log_file, records in records_by_file.items():
+            f = handles.get(log_file)
+            if f is None:
+                f = handles[log_file] = open(log_file, "a", encoding="utf-8")
+            f.write("".join(_json_dumps(record) + "\n" for record in records))
+            f.flush()
+
+def _close_log_files(log_q: queue.Queue, handles: dict, lock: threading.Lock) -> None:
+    """Writes anything still queued, then closes the open log files (registered with atexit)."""
+    _drain_log_queue(log_q, handles, lock)
+    with lock:
+        for f in handles.values():
+            f.close()
+        handles.clear()
+
+def _log_writer(log_q: queue.Queue, handles: dict, lock: threading.Lock) -> None:
+    """Background writer: waits for a record, lets more accumulate briefly, then writes them together."""
+    while True:
+        first = log_q.get() # Block until something is queued
+        time.sleep(LOG_FLUSH_INTERVAL)
+        try:
+            _drain_log_queue(log_q, handles, lock, [first])
+        except Exception as e:
+            print(f"Could not write log records: {e}")
+
+@st.cache_resource
+def _get_log_queue() -> queue.Queue:
+    """Process-wide log queue drained by a daemon writer thread (and once more at exit)."""
+    log_q = queue.Queue()
+    handles, lock = {}, threading.Lock() # log_file -> open file, shared by the writer and the exit hook
+    threading.Thread(target=_log_writer, args=(log_q, handles, lock), name="log-writer", daemon=True).start()
+    atexit.register(_close_log_files, log_q, handles, lock)
+    return log_q
+
+def log_usage(record: dict) -> None:
+    """Queues a usage-log record; the disk write happens off the request path."""
+    _get_log_queue().put((USAGE_LOG_FILE, record))
+
+def save_batch_job(job: dict) -> None:
+    """Queues a submitted job's metadata for BATCH_JOBS_FILE (results are not stored; OpenAI keeps them)."""
+    _get_log_queue().put((BATCH_JOBS_FILE, {k: v for k, v in job.items() if k != "results"}))
+
+# Exact fallback phrase AGENT_PROMPT asks for; also returned locally for near-empty pages
+FALLBACK_LINE = "No usable opening line found based on the provided text."
+
 # Refined Agent Prompt V11 (Include Relevant Testimonials/Articles)
-AGENT_PROMPT = textwrap.dedent("""\
-    You are an elite AI copywriter crafting personalized cold‑email opening lines for Remotebase.   
-    Remotebase helps tech leaders hire pre‑vetted remote engineers fast, cut hiring cycles, and scale teams cost‑effectively.
+# Keep this text byte-identical between runs and above 1024 tokens: OpenAI caches
+# identical prompt prefixes of that length, discounting the instructions on every call.
+AGENT_PROMPT = """\
+You are an elite AI copywriter crafting personalized cold‑email opening lines for Remotebase.   
+Remotebase helps tech leaders hire pre‑vetted remote engineers fast, cut hiring cycles, and scale teams cost‑effectively.
+
+INPUT FORMAT:
+- PAGE_URL: The URL where the text originated.  
+- PAGE_TEXT: The content scraped from that page.  
+- EMAIL_PURPOSE: (Optional) The specific Remotebase offer or angle, e.g., "fill open senior‑backend roles quickly," "cover a skills gap before funding closes," etc.
 
-    INPUT FORMAT:
-    - PAGE_URL: The URL where the text originated.  
-    - PAGE_TEXT: The content scraped from that page.  
-    - EMAIL_PURPOSE: (Optional) The specific Remotebase offer or angle, e.g., "fill open senior‑backend roles quickly," "cover a skills gap before funding closes," etc.
+CRITICAL CONSTRAINTS:
+● **USE ONLY PROVIDED TEXT:** Base the line strictly on the PAGE_TEXT—no outside facts or guesses.  
+● **NO INVENTION:** Do not invent numbers, achievements, pain points, or dates.  
+● **ONE SENTENCE ONLY:** Produce exactly one concise sentence (≤ 30 words).  
+● **FINAL FALLBACK:** If nothing usable exists, output the exact phrase:  
+  `No usable opening line found based on the provided text.`
 
-    CRITICAL CONSTRAINTS:
-    ● **USE ONLY PROVIDED TEXT:** Base the line strictly on the PAGE_TEXT—no outside facts or guesses.  
-    ● **NO INVENTION:** Do not invent numbers, achievements, pain points, or dates.  
-    ● **ONE SENTENCE ONLY:** Produce exactly one concise sentence (≤ 30 words).  
-    ● **FINAL FALLBACK:** If nothing usable exists, output the exact phrase:  
-      `No usable opening line found based on the provided text.`
+HIERARCHY & STEPS (stop at the first that succeeds):
 
-    HIERARCHY & STEPS (stop at the first that succeeds):
+1. **Specific Pain/Trigger (Priority 1):**  
+   • Hunt PAGE_TEXT for clear signals that the company is hiring engineers, expanding product lines, recently funded, facing talent shortages, or experiencing rapid growth.  
+   • If found **and** relevant to EMAIL_PURPOSE, craft a natural sentence linking that trigger to how Remotebase supplies vetted engineers fast (mentioning time‑to‑hire, quality, or cost benefits).  
 
-    1. **Specific Pain/Trigger (Priority 1):**  
-       • Hunt PAGE_TEXT for clear signals that the company is hiring engineers, expanding product lines, recently funded, facing talent shortages, or experiencing rapid growth.  
-       • If found **and** relevant to EMAIL_PURPOSE, craft a natural sentence linking that trigger to how Remotebase supplies vetted engineers fast (mentioning time‑to‑hire, quality, or cost benefits).  
+2. **Recent Achievement (Priority 2):**  
+   • If no hiring trigger, look for verifiable, recent wins: funding rounds, product launches, user milestones, speed‑to‑market claims, engineering accolades.  
+   • Tie that win to how Remotebase can help sustain or accelerate momentum with on‑demand engineering talent.  
 
-    2. **Recent Achievement (Priority 2):**  
-       • If no hiring trigger, look for verifiable, recent wins: funding rounds, product launches, user milestones, speed‑to‑market claims, engineering accolades.  
-       • Tie that win to how Remotebase can help sustain or accelerate momentum with on‑demand engineering talent.  
+3. **Broader Alignment (Priority 3):**  
+   • If nothing above, find a broad technology‑stack or remote‑work reference (e.g., "building in React," "remote‑first culture").  
+   • Write a sentence linking that reference to Remotebase's remote developer network.  
 
-    3. **Broader Alignment (Priority 3):**  
-       • If nothing above, find a broad technology‑stack or remote‑work reference (e.g., "building in React," "remote‑first culture").  
-       • Write a sentence linking that reference to Remotebase's remote developer network.  
+4. **Generic Compliment (Priority 4):**  
+   • If still nothing, identify the company or person's name and write a polite, generic acknowledgment of their work, segueing to Remotebase's value.  
 
-    4. **Generic Compliment (Priority 4):**  
-       • If still nothing, identify the company or person's name and write a polite, generic acknowledgment of their work, segueing to Remotebase's value.  
+5. **Final Fallback (Priority 5):**  
+   • If no usable info at all, output: `No usable opening line found based on the provided text.`
 
-    5. **Final Fallback (Priority 5):**  
-       • If no usable info at all, output: `No usable opening line found based on the provided text.`
+INPUT FORMAT DETAILS (reference only—this describes how each input is assembled and changes none of the rules above):
+– Fields always arrive in the same order: EMAIL_PURPOSE, then PAGE_URL, then PAGE_TEXT, each starting on its own line and separated by one blank line.  
+– EMAIL_PURPOSE is free text typed by the sender. When the sender left it empty, the field reads `(none)`.  
+– PAGE_URL is the address that was scraped, exactly as the sender entered it. It may point to a homepage, an about page, a careers page, a blog post, a press release, or a personal profile.  
+– PAGE_TEXT is the page converted to Markdown by a scraper. It follows the `PAGE_TEXT:` label on the next line and runs to the end of the input.  
+– Markdown conventions in PAGE_TEXT: headings start with one to six `#` characters; list items start with `-`, `*`, or a number followed by a period; emphasis uses `*` or `_`; links appear as `[link text](address)`; images appear as `![alt text](address)`; tables use `|` between cells with a `---` row under the header; code appears between backticks.  
+– The scraper may keep page furniture alongside the main content: navigation menus, cookie or consent notices, newsletter sign‑up boxes, footers with legal links, social‑media buttons, and copyright lines.  
+– Relative links may appear as paths starting with `/`; they belong to the same site as PAGE_URL.  
+– Images carry no description beyond their alt text, which is often empty or a file name.  
+– Forms, buttons, and input fields are reduced to their visible labels, when they have any.  
+– Text hidden behind tabs, accordions, or "read more" buttons is present only if the page rendered it when it was scraped.  
+– Content that scripts load late, such as job listings embedded from another service, may be missing.  
+– Pages behind a login, paywall, or bot check often arrive as a short notice in place of the real content.  
+– Scraped pages are capped at roughly 96,000 characters before any further shortening.  
+– Dates on the page appear in whatever format the site uses, and the page itself may be old; the input carries no separate publication or scrape date.  
+– Long pages are shortened before they are sent. PAGE_TEXT may therefore stop mid‑sentence or mid‑word at its end.  
+– When a long page is shortened to the parts that best match EMAIL_PURPOSE, PAGE_TEXT consists of several excerpts in their original page order, separated by a line containing only `---`. Text between two excerpts has been left out.  
+– Excerpts of very long paragraphs can overlap slightly, so a sentence may appear at the end of one excerpt and again at the start of the next.  
+– Repeated blocks of identical text may already have been removed, so a section heading can be followed directly by a different section.  
+– Non‑English pages are passed through unchanged, including any mixture of languages on the same page.  
+– Characters such as curly quotes, non‑breaking spaces, em dashes, and emoji are preserved as they appear on the page.  
+– Each input (each `INPUT_<n>` in batch mode) describes exactly one page. No earlier inputs, sender details, recipient details, or conversation history are provided.  
 
-    OUTPUT RULES:
-    – Output **only** the single sentence or the fallback phrase—no labels, quotes, or extra commentary.  
-    – Keep wording varied and natural across different runs.
-""")
+OUTPUT RULES:
+– Output **only** the single sentence or the fallback phrase—no labels, quotes, or extra commentary.  
+– Keep wording varied and natural across different runs.
+"""
+
+# Batch variant: several pages in one request, answered as a JSON array
+AGENT_PROMPT_BATCH = AGENT_PROMPT + """
+BATCH MODE (overrides the output rules above):
+– The input contains several pages, each introduced by `INPUT_<n>:` and separated by `---`.
+– Apply every rule above to each input independently; never mix facts between inputs.
+– Output **only** a JSON object of the form {"lines": ["<line for INPUT_1>", "<line for INPUT_2>", ...]} with exactly one entry per input, in input order.
+"""
 
 # Define the Personalization Agent globally - COMMENTING OUT
 # personalization_agent = Agent(
@@ -181,15 +473,332 @@ AGENT_PROMPT = textwrap.dedent("""\
 #     model="o4-mini" # Keeping gpt-4o
 # )
 
+@st.cache_resource
+def _get_async_client():
+    """Process-wide AsyncOpenAI client, registered as the Agents SDK default so every run shares its connection pool."""
+    import httpx
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    from agents import set_default_openai_client
+    async_client = AsyncOpenAI(
+        api_key=OPENAI_KEY,
+        max_retries=OPENAI_MAX_RETRIES,
+        http_client=DefaultAsyncHttpxClient(timeout=httpx.Timeout(**OPENAI_TIMEOUT), limits=httpx.Limits(**OPENAI_HTTP_LIMITS))
+    )
+    set_default_openai_client(async_client)
+    return async_client
+
+@st.cache_resource
+def get_agent(model_id: str) -> "Agent":
+    """Returns the Personalization Agent for `model_id`, built once per model."""
+    from agents import Agent
+    _get_async_client()
+    return Agent(
+        name="Personalization Agent",
+        instructions=AGENT_PROMPT,
+        model=model_id
+    )
+
+@st.cache_resource
+def get_batch_agent(model_id: str) -> "Agent":
+    """Returns the multi-page (JSON output) variant of the Personalization Agent."""
+    from agents import Agent
+    _get_async_client()
+    return Agent(
+        name="Personalization Agent (Batch)",
+        instructions=AGENT_PROMPT_BATCH,
+        model=model_id
+    )
+
+def build_agent_input(url: str, page_text: str, email_purpose: str, max_chars: int = MAX_CONTEXT_CHARS, precise_tokens: bool = False) -> str:
+    """Builds the PAGE_URL / EMAIL_PURPOSE / PAGE_TEXT input for a single page.
+
+    A page longer than `max_chars` with an email purpose is first cut down to the
+    chunks that best match the purpose (BM25), kept in page order; chunk sizes are
+    estimated, so this needs no tokenizer. It is CPU-bound on long pages, so call
+    it off the event loop (asyncio.to_thread) from coroutines. With
+    `precise_tokens`, the page text is cut to the matching token budget
+    (MAX_CONTEXT_TOKENS scaled by `max_chars`) instead of the character limit.
+    """
+    if email_purpose and len(page_text) > max_chars:
+        chunks = create_context_chunks(page_text, max_tokens=RELEVANCE_CHUNK_TOKENS, overlap=50)
+        page_text = CHUNK_SEPARATOR.join(select_relevant_chunks(chunks, email_purpose, max_chars))
+    if precise_tokens:
+        full_context = truncate_to_tokens(page_text, MAX_CONTEXT_TOKENS * max_chars // MAX_CONTEXT_CHARS)
+    else:
+        # The agent reads the context as one blob, so chunking and re-joining buys nothing
+        full_context = page_text[:max_chars]
+
+    # Most stable field first: OpenAI caches identical prompt prefixes, and the purpose
+    # usually stays the same across a session while the URL and page text change
+    return (
+        f"EMAIL_PURPOSE: {email_purpose or '(none)'}\n\n"
+        f"PAGE_URL: {url}\n\n"
+        f"PAGE_TEXT:\n{full_context}"
+    )
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def build_agent_input_cached(url: str, email_purpose: str, page_text_hash: str, precise_tokens: bool, _page_text: str) -> str:
+    """Memoized `build_agent_input` for regenerations; `page_text_hash` stands in for `_page_text` in the key."""
+    return build_agent_input(url, _page_text, email_purpose, precise_tokens=precise_tokens)
+
+class _RateLimiter:
+    """Rolling one-minute request and token budget shared by every agent call on the background loop."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm, self.tpm = rpm, tpm
+        self.calls = collections.deque() # (monotonic time, estimated tokens) of calls in the last minute
+        self.tokens = 0
+        self.lock = None # Created on first use, inside the loop
+
+    async def acquire(self, tokens: int) -> None:
+        """Waits until a call estimated at `tokens` tokens fits in the last minute's budget."""
+        if not (self.rpm or self.tpm):
+            return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.calls and now - self.calls[0][0] >= 60:
+                    self.tokens -= self.calls.popleft()[1]
+                fits_rpm = not self.rpm or len(self.calls) < self.rpm
+                # A call larger than the whole budget goes through once the window is empty
+                fits_tpm = not self.tpm or self.tokens + tokens <= self.tpm or not self.calls
+                if fits_rpm and fits_tpm:
+                    self.calls.append((now, tokens))
+                    self.tokens += tokens
+                    return
+                await asyncio.sleep(60 - (now - self.calls[0][0]))
+
+@st.cache_resource
+def _get_rate_limiter() -> _RateLimiter:
+    """Process-wide limiter for agent calls, configured by OPENAI_RPM / OPENAI_TPM."""
+    return _RateLimiter(OPENAI_RPM, OPENAI_TPM)
+
+async def _run_agent(agent: "Agent", input_text: str, delta_q: queue.Queue = None):
+    """Runs `agent` under the rate limiter, retrying sustained 429s with jittered exponential backoff.
+
+    Streams text deltas to `delta_q` when given. Returns the run result.
+    """
+    from agents import Runner
+    from openai import RateLimitError
+    limiter = _get_rate_limiter()
+    # Estimated request size: instructions + input + a short reply
+    tokens = approx_tokens(agent.instructions) + approx_tokens(input_text) + RESPONSE_TOKEN_BUDGET
+    for attempt in range(AGENT_MAX_ATTEMPTS):
+        await limiter.acquire(tokens)
+        try:
+            if delta_q is None:
+                return await Runner.run(agent, input_text)
+            from openai.types.responses import ResponseTextDeltaEvent
+            result = Runner.run_streamed(agent, input_text)
+            async for event in result.stream_events():
+                if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
+                    delta_q.put(event.data.delta)
+            return result
+        except RateLimitError:
+            if attempt == AGENT_MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(random.uniform(1, min(30, 2 ** (attempt + 1))))
+
 # Renamed function to run the Personalization Agent
-async def run_personalization_agent(agent: Agent, input_text: str) -> str:
-    """Runs the personalization agent with the provided input text."""
+async def run_personalization_agent(agent: "Agent", input_text: str, delta_q: queue.Queue = None) -> str:
+    """Runs the personalization agent with the provided input text.
+
+    Runs on the background event loop, where Streamlit calls are not rendered,
+    so errors are raised for the caller to display. If `delta_q` is given, the
+    reply is streamed and each text delta is put on it as it arrives.
+    """
+    result = await _run_agent(agent, input_text, delta_q)
+    if DEBUG_PROMPT_CACHE:
+        usage = result.context_wrapper.usage
+        cached = getattr(getattr(usage, "input_tokens_details", None), "cached_tokens", None)
+        print(f"Agent usage: {usage.input_tokens} input tokens, {cached} cached") # Debug print
+    return result.final_output
+
+async def run_batch_agent(agent: "Agent", input_texts: List[str]) -> List[str]:
+    """Generates one opening line per input with a single agent call.
+
+    Raises ValueError if the reply is not a JSON object holding exactly one line per input.
+    """
+    packed = "\n---\n".join(f"INPUT_{i}:\n{text}" for i, text in enumerate(input_texts, start=1))
+    result = await _run_agent(agent, packed)
+    output = result.final_output.strip()
+    # Tolerate replies wrapped in a ```json fence
+    if output.startswith("```"):
+        output = output.strip("`").removeprefix("json").strip()
+    lines = json.loads(output).get("lines")
+    if not isinstance(lines, list) or len(lines) != len(input_texts):
+        raise ValueError(f"Expected {len(input_texts)} lines, got: {output[:200]}")
+    return [str(line).strip() for line in lines]
+
+def submit_batch(urls: List[str], pages: dict, model_id: str, email_purpose: str, precise_tokens: bool = False):
+    """Submits one chat completion per scraped URL as an OpenAI Batch job (24h window, ~50% cheaper).
+
+    `pages` maps url -> markdown; URLs whose scrape failed are left out, and so are
+    unusable pages (as in the synchronous pipeline). Returns (batch, skipped_urls),
+    where skipped_urls are the unusable pages, which get FALLBACK_LINE.
+    """
+    lines, skipped = [], []
+    for url in dict.fromkeys(urls): # custom_id must be unique within a batch
+        page_md = pages.get(url)
+        if not isinstance(page_md, str):
+            continue
+        if _unusable_page(page_md):
+            skipped.append(url) # Not worth a paid request
+            continue
+        request = {
+            "custom_id": url,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model_id,
+                "messages": [
+                    {"role": "system", "content": AGENT_PROMPT},
+                    {"role": "user", "content": build_agent_input(url, page_md, email_purpose, precise_tokens=precise_tokens)},
+                ],
+            },
+        }
+        lines.append(_json_dumps(request))
+    if not lines:
+        raise RuntimeError("None of the URLs could be scraped into a usable page; nothing to submit.")
+
+    client = get_openai_client()
+    batch_file = client.files.create(file=("batch_input.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    return batch, skipped
+
+def _batch_error_message(record: dict) -> str:
+    """Best available error text for a failed batch request record."""
+    error = record.get("error") or ((record.get("response") or {}).get("body") or {}).get("error")
+    if isinstance(error, dict):
+        error = error.get("message") or error.get("code")
+    if not error and record.get("response"):
+        error = f"HTTP {record['response'].get('status_code')}"
+    return str(error or "no output returned")
+
+def fetch_batch_results(batch) -> List[dict]:
+    """Downloads a completed batch's output (and error) files as url/opening_line/status rows.
+
+    Either file may be missing: `output_file_id` is None when every request failed,
+    and `error_file_id` is None when none did.
+    """
+    client = get_openai_client()
+    rows = []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = _json_loads(line)
+            try:
+                opening_line = record["response"]["body"]["choices"][0]["message"]["content"].strip()
+                rows.append({"url": record["custom_id"], "opening_line": opening_line, "status": "success"})
+            except (KeyError, IndexError, TypeError):
+                rows.append({"url": record.get("custom_id"), "opening_line": f"Error: {_batch_error_message(record)}", "status": "error"})
+    return rows
+
+@st.cache_data(ttl=1800, max_entries=256, show_spinner=False)
+def generate_line(model_id: str, url: str, email_purpose: str, page_text_hash: str, precise_tokens: bool, variant: str,
+                  _page_text: str, _delta_q: queue.Queue = None) -> str:
+    """Generates the opening line for a page, memoized across reruns and sessions.
+
+    `_page_text` and `_delta_q` are excluded from the cache key (leading underscore);
+    `page_text_hash` stands in for the text. Pass a fresh `variant` (any new string)
+    to bypass the cache and get a new line. On a cache miss the reply is streamed to `_delta_q`.
+    """
+    if _unusable_page(_page_text):
+        return FALLBACK_LINE # The agent could only answer with the fallback; skip the call
+    input_text = build_agent_input_cached(url, email_purpose, page_text_hash, precise_tokens, _page_text)
+    return run_async(run_personalization_agent(get_agent(model_id), input_text, _delta_q))
+
+async def scrape_and_generate(urls: List[str], model_id: str, email_purpose: str, pages_per_request: int,
+                              precise_tokens: bool, progress_q: queue.Queue = None,
+                              wait_ms: int = 4000, concurrency: int = SCRAPE_CONCURRENCY):
+    """Scrapes `urls` and generates their opening lines as one pipeline.
+
+    Pages are scraped concurrently (at most `concurrency` in flight), and every
+    `pages_per_request` scraped pages go to the agent straight away instead of
+    waiting for the slowest scrape (at most GENERATE_CONCURRENCY requests in flight).
+    Returns (pages, lines, statuses), each keyed by url: markdown or Exception, the
+    opening line (or error text), and "success", "error" or "skipped" (page unusable,
+    FALLBACK_LINE given without calling the agent). Each finished URL is put
+    on `progress_q` so the script thread can report progress.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    generate_sem = asyncio.Semaphore(GENERATE_CONCURRENCY)
+    agent = get_agent(model_id)
+    # Share the context budget between the pages packed into one request
+    page_budget = MAX_CONTEXT_CHARS // pages_per_request
+    pages, lines_by_url, statuses = {}, {}, {}
+
+    def finish(url: str, opening_line: str, status: str) -> None:
+        lines_by_url[url] = opening_line
+        statuses[url] = status
+        if progress_q is not None:
+            progress_q.put(url)
+
+    async def scrape(url: str):
+        async with sem:
+            try:
+                # Firecrawl's SDK is synchronous, so run each call in a worker thread
+                return url, await asyncio.to_thread(scrape_page, url, wait_ms, True)
+            except Exception as e:
+                return url, e
+
+    async def generate(group: List[tuple]) -> None:
+        texts = [text for _, text in group]
+        try:
+            async with generate_sem:
+                if len(group) == 1:
+                    lines = [await run_personalization_agent(agent, texts[0])]
+                else:
+                    try:
+                        lines = await run_batch_agent(get_batch_agent(model_id), texts)
+                    except Exception:
+                        # Malformed batch reply - fall back to one request per page
+                        lines = [await run_personalization_agent(agent, text) for text in texts]
+            for (url, _), line in zip(group, lines):
+                finish(url, line, "success")
+        except Exception as e:
+            for url, _ in group:
+                finish(url, f"Error: {str(e)}", "error")
+
+    group, generating = [], []
     try:
-        result = await Runner.run(agent, input_text)
-        return result.final_output
-    except Exception as e:
-        st.error(f"Error running agent: {e}")
-        return "Sorry, I encountered an error trying to generate the opening line."
+        for next_scraped in asyncio.as_completed([scrape(u) for u in dict.fromkeys(urls)]):
+            url, page_md = await next_scraped
+            pages[url] = page_md
+            if isinstance(page_md, Exception):
+                finish(url, f"Error: {str(page_md)}", "error")
+                continue
+            if _unusable_page(page_md):
+                finish(url, FALLBACK_LINE, "skipped")
+                continue
+            try:
+                # Chunking and ranking long pages is CPU work; keep it off the loop running the agent calls
+                input_text = await asyncio.to_thread(build_agent_input, url, page_md, email_purpose, page_budget, precise_tokens)
+            except Exception as e:
+                finish(url, f"Error: {str(e)}", "error")
+                continue
+            group.append((url, input_text))
+            if len(group) == pages_per_request:
+                generating.append(asyncio.create_task(generate(group)))
+                group = []
+        if group:
+            generating.append(asyncio.create_task(generate(group)))
+        await asyncio.gather(*generating)
+    except BaseException:
+        # Don't leave agent calls running (and billing) for a run that has failed or been cancelled
+        for task in generating:
+            task.cancel()
+        raise
+    return pages, lines_by_url, statuses
 
 # ----------------- STREAMLIT LAYOUT -----------------
 st.set_page_config(page_title=APP_NAME, page_icon="✨", layout="wide")
@@ -214,20 +823,32 @@ with st.sidebar:
 
     if input_method == "Single URL":
         st.header("2. Analyze Page")
-        url = st.text_input("Enter profile/company URL...", placeholder="https://example.com/about")
+        url = st.text_input("Enter profile/company URL...", placeholder="https://example.com/about").strip()
         use_wait = st.checkbox("Use comprehensive text extraction (wait for JS)")
+        refresh_scrape = st.checkbox("Re-scrape (ignore cached copy)", help="Pages are reused for 24 hours; tick to fetch the live page again.")
         analyze_button = st.button("📊 Analyze Page Content", use_container_width=True)
     else:
         st.header("2. Upload CSV")
         uploaded_file = st.file_uploader("Upload CSV file with URLs", type=['csv'])
+        pages_per_request = st.number_input(
+            "Pages per model request",
+            min_value=1, max_value=10, value=1,
+            help="Above 1, several pages share one request (and its context budget) to save round trips and prompt tokens."
+        )
+        use_batch_api = st.checkbox(
+            "Submit as OpenAI batch job",
+            help="Results arrive within 24h at roughly half the cost. Track them under Jobs below."
+        )
         if uploaded_file is not None:
+            import pandas as pd
             df = pd.read_csv(uploaded_file)
             st.write("Preview of your CSV:")
             st.dataframe(df.head())
             url_column = st.selectbox("Select the column containing URLs", df.columns)
             if url_column:
-                st.session_state.csv_urls = df[url_column].tolist()
-                st.write(f"Found {len(st.session_state.csv_urls)} URLs to process")
+                state.csv_urls = df[url_column].tolist()
+                unique_count = len(set(state.csv_urls))
+                st.write(f"Found {len(state.csv_urls)} URLs to process ({unique_count} unique; each is scraped and generated once)")
 
     st.divider()
     
@@ -250,16 +871,68 @@ with st.sidebar:
         options=list(model_options.keys()),
         index=1
     )
+    st.checkbox(
+        "Precise token budget",
+        key="precise_tokens",
+        help="Cut page text to an exact token budget with tiktoken instead of an approximate character limit."
+    )
+    if st.session_state.get("precise_tokens"):
+        # Load the BPE tables as soon as precise mode is on, not on the first Generate click (cached per process)
+        try:
+            get_encoder(ENCODER_MODEL)
+        except Exception as e:
+            st.warning(f"Could not load the tokenizer, so precise token budgets will fail: {e}")
 
     # Generate button is enabled based on input method
     if input_method == "Single URL":
+        new_variant = st.checkbox("New variant (ignore cached line)", help="Identical requests reuse the last line for 30 minutes; tick to generate a fresh one.")
         generate_button = st.button("✨ Generate Opening Line", 
                                   use_container_width=True, 
-                                  disabled=not st.session_state.get("page_text"))
+                                  disabled=not state.page_text)
     else:
         generate_button = st.button("✨ Process CSV", 
                                   use_container_width=True, 
-                                  disabled=not st.session_state.get("csv_urls"))
+                                  disabled=not state.csv_urls)
+
+    # Background OpenAI batch jobs
+    if state.batch_jobs:
+        st.divider()
+        st.header("Jobs")
+        refresh_jobs = st.button("🔄 Refresh job status", use_container_width=True)
+        for job in state.batch_jobs:
+            if refresh_jobs and job["status"] not in ("completed", "failed", "expired", "cancelled"):
+                try:
+                    job["status"] = get_openai_client().batches.retrieve(job["id"]).status
+                except Exception as e:
+                    st.warning(f"Could not refresh {job['id']}: {e}")
+            st.caption(f"{job['submitted']} · {job['model']} · {job['count']} URLs · **{job['status']}**")
+            if job["status"] == "completed":
+                if job.get("results") is None:
+                    try:
+                        job["results"] = fetch_batch_results(get_openai_client().batches.retrieve(job["id"]))
+                    except Exception as e:
+                        st.warning(f"Could not load results for {job['id']}: {e}")
+                        continue # Left unset, so the next rerun tries again
+                # One row per uploaded URL: repeated URLs share a result, failed scrapes show their error,
+                # unusable pages (never submitted) get FALLBACK_LINE
+                by_url = {row["url"]: row for row in job["results"]}
+                skipped = set(job.get("skipped") or ())
+                job_rows = []
+                for url in job.get("urls") or list(by_url):
+                    row = by_url.get(url)
+                    if row is not None:
+                        job_rows.append((url, row["opening_line"], row["status"]))
+                    elif url in skipped:
+                        job_rows.append((url, FALLBACK_LINE, "skipped"))
+                    else:
+                        job_rows.append((url, f"Error: {job.get('scrape_errors', {}).get(url, 'no result returned')}", "error"))
+                st.download_button(
+                    label="Download Results",
+                    data=_to_csv(["url", "opening_line", "status"], job_rows),
+                    file_name=f"opening_lines_{job['id']}.csv",
+                    mime="text/csv",
+                    key=f"download_{job['id']}"
+                )
 
 # ---- Main pane ----
 st.title(f"✨ {APP_NAME}")
@@ -268,159 +941,194 @@ st.markdown('<p class="subheader">Generate personalized cold email opening lines
 # --- Stage 1: Analysis Logic ---
 if input_method == "Single URL" and analyze_button:
     # Reset state before analysis
-    st.session_state.page_text = None
-    st.session_state.source_url = None
-    st.session_state.generated_line = None
+    state.page_text = None
+    state.source_url = None
+    state.generated_line = None
+    st.session_state.pop("page_text_part", None) # The new page may have fewer parts
 
     # Validate URL
     if not url:
         st.warning("Please enter a URL.")
     elif len(url) > MAX_URL_LENGTH:
         st.error(f"URL is too long (max {MAX_URL_LENGTH} characters).")
-    elif "://" not in url:
+    elif not _URL_RE.fullmatch(url):
         st.error("Please enter a valid URL (including http:// or https://).")
     else:
         # Scrape Page
         try:
             scrape_wait_time = 4000 if use_wait else 2000
+            if refresh_scrape:
+                forget_scrape(url, scrape_wait_time, use_wait)
             with st.spinner("Reading page... (please wait)"):
-                page_md = scrape_page(url, wait_ms=scrape_wait_time)
+                page_md = scrape_page(url, wait_ms=scrape_wait_time, main_content_only=use_wait)
             # Store successful scrape results in session state
-            st.session_state.page_text = page_md
-            st.session_state.source_url = url
+            state.page_text = page_md
+            # Hash once here; generation reruns reuse it as the cache key
+            state.page_text_hash = hashlib.blake2b(page_md.encode(), digest_size=8).hexdigest()
+            state.source_url = url
             st.success(f"✅ Analyzed content loaded for: {url}")
             st.rerun()
         except Exception as e:
             st.error(f"Could not analyze page: {e}")
-            st.session_state.page_text = None
-            st.session_state.source_url = None
-            st.session_state.generated_line = None
+            state.page_text = None
+            state.source_url = None
+            state.generated_line = None
 
 # --- Stage 2: Generation Logic --- 
 if generate_button:
     if input_method == "Single URL":
         # Single URL processing
-        if st.session_state.get("page_text") and st.session_state.get("source_url"):
+        if state.page_text and state.source_url:
             with st.spinner("Generating opening line... (please wait)"):
                 try:
                     selected_model_id = model_options[selected_model_name]
-                    local_personalization_agent = Agent(
-                        name="Personalization Agent",
-                        instructions=AGENT_PROMPT,
-                        model=selected_model_id
+                    # Generate on a helper thread and render the reply as it streams in
+                    delta_q = queue.Queue()
+                    generation = call_in_thread(
+                        generate_line,
+                        selected_model_id,
+                        state.source_url,
+                        email_purpose,
+                        state.page_text_hash,
+                        bool(st.session_state.get("precise_tokens")),
+                        uuid.uuid4().hex if new_variant else "", # A fresh key misses the cache
+                        state.page_text,
+                        delta_q
                     )
-                    
-                    context_chunks = create_context_chunks(st.session_state.page_text, max_tokens=3000)
-                    full_context = "\n\n---\n\n".join(context_chunks)[:80000]
-                    
-                    purpose_string = f"EMAIL_PURPOSE: {email_purpose}\n\n" if email_purpose else ""
-                    input_text = (
-                        f"PAGE_URL: {st.session_state.source_url}\n\n"
-                        f"{purpose_string}"
-                        f"PAGE_TEXT:\n{full_context}"
-                    )
-                    
-                    generated_line = asyncio.run(run_personalization_agent(local_personalization_agent, input_text))
-                    st.session_state.generated_line = generated_line
+                    stream_view = st.empty()
+                    streamed = ""
+                    while True:
+                        try:
+                            streamed += delta_q.get(timeout=0.05)
+                        except queue.Empty:
+                            if generation.done():
+                                break # Finished (or served from cache) and every delta shown
+                            continue
+                        stream_view.markdown(streamed)
+                    stream_view.empty()
+                    generated_line = generation.result()
+                    state.generated_line = generated_line
                     
                     # Log usage
                     try:
                         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        log_data = [timestamp, st.session_state.source_url, email_purpose, generated_line]
-                        DATA_DIR.mkdir(parents=True, exist_ok=True)
-                        with open(USAGE_LOG_FILE, "a", newline='', encoding="utf-8") as f:
-                            writer = csv.writer(f)
-                            writer.writerow(log_data)
+                        log_usage({
+                            "ts": timestamp,
+                            "url": state.source_url,
+                            "purpose": email_purpose,
+                            "line": generated_line,
+                        })
                     except Exception as log_e:
                         st.warning(f"Could not log usage data: {log_e}")
 
                 except Exception as agent_e:
                     st.error(f"Generation error: {agent_e}")
-                    st.session_state.generated_line = "Error generating line."
+                    state.generated_line = "Error generating line."
     else:
         # CSV processing
-        if st.session_state.get("csv_urls"):
-            st.session_state.processing_status = "Processing URLs..."
-            st.session_state.csv_results = []
+        if state.csv_urls and use_batch_api:
+            with st.spinner(f"Scraping {len(state.csv_urls)} pages for the batch job..."):
+                state.csv_pages = run_async(scrape_many(state.csv_urls, wait_ms=4000, main_content_only=True))
+            try:
+                selected_model_id = model_options[selected_model_name]
+                batch, skipped = submit_batch(state.csv_urls, state.csv_pages, selected_model_id, email_purpose,
+                                              precise_tokens=bool(st.session_state.get("precise_tokens")))
+                job = {
+                    "id": batch.id,
+                    "submitted": datetime.now().strftime("%Y-%m-%d %H:%M"),
+                    "submitted_ts": time.time(),
+                    "model": selected_model_id,
+                    "count": sum(isinstance(page, str) for page in state.csv_pages.values()) - len(skipped),
+                    "status": batch.status,
+                    "results": None,
+                    "urls": list(state.csv_urls), # Upload order, duplicates included, for the download
+                    "scrape_errors": {url: str(page) for url, page in state.csv_pages.items() if isinstance(page, Exception)},
+                    "skipped": skipped,
+                }
+                state.batch_jobs.append(job)
+                save_batch_job(job)
+                st.success(f"✅ Submitted batch job {batch.id}. Check its status under Jobs in the sidebar.")
+            except Exception as e:
+                st.error(f"Could not submit batch job: {e}")
+        elif state.csv_urls:
+            state.processing_status = "Processing URLs..."
+            state.csv_results = None
             
             progress_bar = st.progress(0)
             status_text = st.empty()
-            
-            for i, url in enumerate(st.session_state.csv_urls):
+
+            # Scrape and generate on the background loop; generation starts as soon as pages arrive
+            total = len(set(state.csv_urls))
+            status_text.text(f"Processing {total} pages...")
+            progress_q = queue.Queue()
+            pipeline = submit_async(scrape_and_generate(
+                state.csv_urls,
+                model_options[selected_model_name],
+                email_purpose,
+                pages_per_request,
+                bool(st.session_state.get("precise_tokens")),
+                progress_q
+            ))
+            done = 0
+            while done < total and not pipeline.done():
                 try:
-                    status_text.text(f"Processing {i+1}/{len(st.session_state.csv_urls)}: {url}")
-                    progress_bar.progress((i + 1) / len(st.session_state.csv_urls))
-                    
-                    # Scrape page
-                    page_md = scrape_page(url, wait_ms=4000)
-                    
-                    # Create context chunks
-                    context_chunks = create_context_chunks(page_md, max_tokens=3000)
-                    full_context = "\n\n---\n\n".join(context_chunks)[:80000]
-                    
-                    # Prepare input for the agent
-                    purpose_string = f"EMAIL_PURPOSE: {email_purpose}\n\n" if email_purpose else ""
-                    input_text = (
-                        f"PAGE_URL: {url}\n\n"
-                        f"{purpose_string}"
-                        f"PAGE_TEXT:\n{full_context}"
-                    )
-                    
-                    # Create and run the agent
-                    selected_model_id = model_options[selected_model_name]
-                    agent = Agent(
-                        name="Personalization Agent",
-                        instructions=AGENT_PROMPT,
-                        model=selected_model_id
-                    )
-                    
-                    result = asyncio.run(run_personalization_agent(agent, input_text))
-                    
-                    st.session_state.csv_results.append({
-                        "url": url,
-                        "opening_line": result,
-                        "status": "success"
-                    })
-                    
-                except Exception as e:
-                    st.session_state.csv_results.append({
-                        "url": url,
-                        "opening_line": f"Error: {str(e)}",
-                        "status": "error"
-                    })
-            
-            # Convert results to DataFrame and display
-            results_df = pd.DataFrame(st.session_state.csv_results)
-            st.dataframe(results_df)
-            
-            # Add download button
-            csv = results_df.to_csv(index=False)
-            st.download_button(
-                label="Download Results",
-                data=csv,
-                file_name="opening_lines_results.csv",
-                mime="text/csv"
-            )
+                    progress_q.get(timeout=0.2)
+                except queue.Empty:
+                    continue
+                done += 1
+                progress_bar.progress(done / total)
+                status_text.text(f"Processed {done} of {total} pages...")
+            try:
+                _, lines_by_url, statuses = pipeline.result() # Pages are only needed by the Batch API path
+            except Exception as e:
+                st.error(f"CSV processing failed: {e}")
+                lines_by_url = None
+            if lines_by_url is not None:
+                progress_bar.progress(1.0)
+
+                # Results are kept column-wise, in upload order
+                state.csv_results = {
+                    "url": list(state.csv_urls),
+                    "opening_line": [lines_by_url[url] for url in state.csv_urls],
+                    "status": [statuses[url] for url in state.csv_urls],
+                }
+
+                # st.dataframe takes the column dict directly
+                st.dataframe(state.csv_results)
+
+                # Add download button
+                st.download_button(
+                    label="Download Results",
+                    data=_to_csv(list(state.csv_results), zip(*state.csv_results.values())),
+                    file_name="opening_lines_results.csv",
+                    mime="text/csv"
+                )
 
 # --- Display Area (runs on every interaction) --- 
 
 # Display info about the loaded page (for single URL mode)
-if input_method == "Single URL" and st.session_state.get("source_url"):
+if input_method == "Single URL" and state.source_url:
     st.divider()
-    st.info(f"Analyzed content loaded for: {st.session_state.source_url}")
+    st.info(f"Analyzed content loaded for: {state.source_url}")
     
-    if st.session_state.get("page_text"):
+    if state.page_text:
          with st.expander("View Analyzed Page Content (Text Format)", expanded=False):
-            st.text_area("Page Text:", value=st.session_state.page_text,
-                        height=300, key="analyzed_text_view", disabled=True)
+            # Expander bodies are sent even when collapsed, so only ship the text on request, one part at a time
+            if st.toggle("Show page text", key="show_page_text"):
+                parts = -(-len(state.page_text) // PAGE_VIEW_CHARS)
+                part = st.number_input("Part", min_value=1, max_value=parts, step=1, key="page_text_part") if parts > 1 else 1
+                start = (part - 1) * PAGE_VIEW_CHARS
+                end = min(start + PAGE_VIEW_CHARS, len(state.page_text))
+                st.text_area(f"Page Text (characters {start + 1:,}–{end:,} of {len(state.page_text):,}):",
+                             value=state.page_text[start:end], height=300, disabled=True)
 
 # Display the generated line if available (for single URL mode)
-if input_method == "Single URL" and st.session_state.get("generated_line"):
+if input_method == "Single URL" and state.generated_line:
     st.subheader("✨ Suggested Opening Line:")
-    st.text_area("Copy this line:", value=st.session_state.generated_line, height=100, key="output_line")
-elif input_method == "Single URL" and generate_button and not st.session_state.get("generated_line"):
+    st.text_area("Copy this line:", value=state.generated_line, height=100, key="output_line")
+elif input_method == "Single URL" and generate_button and not state.generated_line:
      st.warning("Could not generate opening line. Check for errors above or try again.")
 
 # Initial message if no analysis has been triggered yet
-if input_method == "Single URL" and not st.session_state.get("page_text") and not analyze_button:
+if input_method == "Single URL" and not state.page_text and not analyze_button:
     st.info("👈 Enter a URL in the sidebar and click **Analyze Page Content** to start.")
\ No newline at end of file
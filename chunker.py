@@ -0,0 +1,160 @@
+"""Paragraph-aware chunking of scraped Markdown.
+
+Kept free of Streamlit so it can be imported on its own and, if the packing
+loop ever shows up in profiles, compiled in place with `mypyc chunker.py`
+(every function here is fully annotated for that).
+"""
+import re, math
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Iterator, List
+
+import numpy as np
+
+ENCODER_MODEL = "gpt-4o-mini" # tiktoken encoding used for chunking; align with agent model if different
+
+# Average characters per token for English text, used to estimate paragraph sizes without BPE
+CHARS_PER_TOKEN = 3.6
+
+# Separator used when the chunks are stitched back into a single context string
+CHUNK_SEPARATOR = "\n\n---\n\n"
+
+# How far back from a window's end to look for a sentence or line break to cut at
+SPLIT_SNAP_CHARS = 200
+
+# A paragraph break: a blank (or whitespace-only) line; runs of them count as one
+_PARA_BREAK = re.compile(r"\n\s*\n")
+
+# Terms for BM25 ranking: runs of letters and digits, compared lowercased
+_TERM_RE = re.compile(r"\w+")
+
+@lru_cache(maxsize=4)
+def get_encoder(model: str) -> Any:
+    """Returns the tiktoken encoder for `model`, loading the BPE tables once per process."""
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
+def approx_tokens(text: str) -> int:
+    """Rough token count (~CHARS_PER_TOKEN chars per token) used to avoid encoding every paragraph."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def _paragraph_key(para: str) -> str:
+    """Normalized form used to spot repeated boilerplate paragraphs (nav, cookie banners, footers)."""
+    return " ".join(para.lower().split())
+
+def split_oversized(para: str, window_chars: int, overlap_chars: int) -> List[str]:
+    """Splits `para` into overlapping windows of at most `window_chars` characters.
+
+    Each cut is pulled back to the last '. ' or newline within SPLIT_SNAP_CHARS of
+    the window end, when there is one, so windows tend to end on a sentence.
+    """
+    windows: List[str] = []
+    start = 0
+    n = len(para)
+    while start < n:
+        end = min(start + window_chars, n)
+        if end < n:
+            snap_from = max(end - SPLIT_SNAP_CHARS, start + overlap_chars + 1)
+            cut = max(para.rfind(". ", snap_from, end), para.rfind("\n", snap_from, end))
+            if cut >= 0:
+                end = cut + 1 # Keep the period (or newline) with this window
+        windows.append(para[start:end])
+        if end >= n:
+            break
+        start = max(end - overlap_chars, start + 1) # Guard against overlap >= window
+    return windows
+
+def iter_paragraphs(text: str) -> Iterator[str]:
+    """Lazily yields the stripped, non-empty paragraphs of `text`."""
+    start = 0
+    for m in _PARA_BREAK.finditer(text):
+        para = text[start:m.start()].strip()
+        if para:
+            yield para
+        start = m.end()
+    para = text[start:].strip()
+    if para:
+        yield para
+
+# Improved Chunking Function
+def create_context_chunks(markdown_text: str, max_tokens: int = 3000, overlap: int = 100) -> List[str]:
+    """Creates text chunks respecting paragraphs, splitting large paragraphs with overlap.
+
+    Repeated paragraphs are dropped. Paragraph sizes are estimated with
+    `approx_tokens` rather than tokenized, so no encoder is loaded and chunks can
+    run slightly over `max_tokens`.
+    """
+    # Fast path: even at a pessimistic 3 chars per token, text this short fits in one chunk
+    if len(markdown_text) <= max_tokens * 3:
+        return [markdown_text.strip()]
+
+    paragraphs: List[str] = []
+    seen = set()
+    for para in iter_paragraphs(markdown_text):
+        key = _paragraph_key(para)
+        if key in seen:
+            continue # Drop repeated boilerplate
+        seen.add(key)
+        paragraphs.append(para)
+
+    para_counts = np.fromiter((approx_tokens(p) for p in paragraphs), dtype=np.int64, count=len(paragraphs))
+    # Prefix sums of (paragraph + 2-token '\n\n' separator); a chunk spanning
+    # paragraphs i..k-1 costs cum[k-1] - cum[i-1] - 2 tokens.
+    cum = np.cumsum(para_counts + 2)
+
+    chunks: List[str] = []
+    i = 0
+    while i < len(paragraphs):
+        # Case 1: Single paragraph is too large - split it with overlap on sentence-snapped
+        # character boundaries, sized from its chars-per-token ratio
+        if para_counts[i] > max_tokens:
+            para = paragraphs[i]
+            window_chars = max(len(para) * max_tokens // int(para_counts[i]), 1)
+            overlap_chars = window_chars * overlap // max_tokens
+            chunks.extend(split_oversized(para, window_chars, overlap_chars))
+            i += 1
+            continue
+
+        # Case 2: Greedily take every following paragraph that still fits. The search
+        # also stops before any oversized paragraph, whose cost alone exceeds the limit.
+        base = cum[i - 1] if i else 0
+        end = int(np.searchsorted(cum, base + max_tokens + 2, side="right"))
+        chunks.append('\n\n'.join(paragraphs[i:end]))
+        i = end
+
+    # If no chunks were created (e.g., empty input), return a list with an empty string
+    if not chunks:
+         return [""]
+
+    return chunks
+
+def bm25_scores(chunks: List[str], query: str, k1: float = 1.5, b: float = 0.75) -> Any:
+    """Okapi BM25 score of each chunk against `query`, as a float array aligned with `chunks`."""
+    docs = [Counter(_TERM_RE.findall(c.lower())) for c in chunks]
+    lengths = np.fromiter((sum(d.values()) for d in docs), dtype=np.float64, count=len(docs))
+    length_norm = k1 * (1 - b + b * lengths / (lengths.mean() or 1.0))
+    scores = np.zeros(len(docs))
+    for term in set(_TERM_RE.findall(query.lower())):
+        tf = np.fromiter((d[term] for d in docs), dtype=np.float64, count=len(docs))
+        df = int(np.count_nonzero(tf))
+        if df:
+            idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+            scores += idf * tf * (k1 + 1) / (tf + length_norm)
+    return scores
+
+def select_relevant_chunks(chunks: List[str], query: str, max_chars: int) -> List[str]:
+    """Keeps the chunks that best match `query` (BM25) while they fit in `max_chars`.
+
+    Chunks are returned in page order, as joined with `CHUNK_SEPARATOR`. If no chunk
+    shares a term with the query, the leading chunks are kept instead.
+    """
+    scores = bm25_scores(chunks, query)
+    order = np.argsort(-scores, kind="stable") if scores.any() else range(len(chunks))
+    keep: List[int] = []
+    used = 0
+    for i in order:
+        cost = len(chunks[i]) + (len(CHUNK_SEPARATOR) if keep else 0)
+        if used + cost <= max_chars:
+            keep.append(int(i))
+            used += cost
+    return [chunks[i] for i in sorted(keep)]